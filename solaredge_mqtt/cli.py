@@ -2,16 +2,16 @@
 This file contains the CLI script entry points
 """
 
-import argparse
-import codecs
-import configparser
+import functools
 import logging
-import multiprocessing
-import time
-from typing import Any, Dict, List
+import os
+import sys
+from typing import TYPE_CHECKING, Any, Callable, Dict, List, Optional, Tuple
 
-from .mqtt import mqtt_main
-from .solaredge import solaredge_main
+from . import __version__
+
+if TYPE_CHECKING:
+    import argparse
 
 logging.basicConfig(
     format="%(asctime)-15s %(levelname)s: %(message)s", level=logging.INFO
@@ -29,77 +29,211 @@ DEFAULTS: Dict[str, Any] = {
     "time_offset": 0,
 }
 
+# Options read from the `general` section of the config file: the
+# option name in the file, the config key it is stored in, and the
+# function used to convert the value
+_CONFIG_OPTIONS: Tuple[Tuple[str, str, Callable[[str], Any]], ...] = (
+    ("solaredge-host", "solaredge_host", str),
+    ("solaredge-port", "solaredge_port", int),
+    ("read-every", "read_every", float),
+    ("time-offset", "time_offset", float),
+    ("mqtt-host", "mqtt_host", str),
+    ("mqtt-port", "mqtt_port", int),
+    ("mqtt-client-id", "mqtt_client_id", str),
+    ("buffer-size", "buffer_size", int),
+)
+
+# Command line arguments that are merged into the config, as pairs of
+# argparse attribute name and config key
+_CLI_KEYS: Tuple[Tuple[str, str], ...] = (
+    ("solaredge_host", "solaredge_host"),
+    ("solaredge_port", "solaredge_port"),
+    ("read_every", "read_every"),
+    ("time_offset", "time_offset"),
+    ("mqtt_topic", "mqtt_topic"),
+    ("mqtt_host", "mqtt_host"),
+    ("mqtt_port", "mqtt_port"),
+    ("mqtt_client_id", "mqtt_client_id"),
+    ("buffer_size", "buffer_size"),
+)
+
+
+def _parse_ini(filename: str) -> Dict[str, Dict[str, str]]:
+    """
+    Parse the ini style file given by `filename` into a dictionary
+    of sections, each containing a dictionary of options.
+
+    This follows the rules of configparser with its default settings,
+    minus interpolation: `[section]` headers, `key = value` and
+    `key: value` lines, continuation lines indented deeper than the
+    line holding the key, comment lines starting with `#` or `;` and a
+    `[DEFAULT]` section whose options apply to all other sections.
+    Option names are lower cased. Duplicate sections or options are
+    an error.
+    """
+
+    defaults: Dict[str, List[str]] = {}
+    sections: Dict[str, Dict[str, List[str]]] = {}
+    current: Optional[Dict[str, List[str]]] = None
+    key: Optional[str] = None
+    key_indent = 0
+    with open(filename, encoding="utf-8") as configfile:
+        for lineno, rawline in enumerate(configfile, start=1):
+            line = rawline.strip()
+            if line and line[0] in "#;":
+                continue
+
+            if not line:
+                # Empty lines are part of a value if more continuation
+                # lines follow
+                if current is not None and key is not None:
+                    current[key].append("")
+                continue
+
+            indent = len(rawline) - len(rawline.lstrip())
+            if current is not None and key is not None and indent > key_indent:
+                current[key].append(line)
+                continue
+
+            key_indent = indent
+
+            # Anything up to the last closing bracket is the section
+            # name, the rest of the line is ignored
+            close = line.rfind("]")
+            if line[0] == "[" and close > 1:
+                name = line[1:close]
+                if name == "DEFAULT":
+                    current = defaults
+                elif name in sections:
+                    raise ValueError("Duplicate section %s in line %d" % (name, lineno))
+                else:
+                    current = sections[name] = {}
+                key = None
+                continue
+
+            if current is None:
+                raise ValueError("Option outside of a section in line %d" % lineno)
+
+            # Split on the first delimiter, whichever it is
+            split = min(
+                (pos for pos in (line.find("="), line.find(":")) if pos >= 0),
+                default=-1,
+            )
+            if split < 0:
+                raise ValueError("Missing '=' or ':' in line %d" % lineno)
+            key = line[:split].rstrip().lower()
+            if not key:
+                raise ValueError("Missing option name in line %d" % lineno)
+            if key in current:
+                raise ValueError("Duplicate option %s in line %d" % (key, lineno))
+            current[key] = [line[split + 1 :].strip()]
+
+    return {
+        name: {
+            option: "\n".join(value).rstrip()
+            for option, value in {**defaults, **options}.items()
+        }
+        for name, options in sections.items()
+    }
+
 
 def load_config_file(filename: str) -> Dict[str, Any]:
     """
     Load the ini style config file given by `filename`
+
+    The result is cached for as long as the modification time
+    of the file does not change.
     """
 
-    config: Dict[str, Any] = {}
-    ini = configparser.ConfigParser()
     try:
-        with codecs.open(filename, encoding="utf-8") as configfile:
-            ini.read_file(configfile)
-    except Exception as exc:
+        mtime_ns = os.stat(filename).st_mtime_ns
+    except OSError as exc:
         LOGGER.error("Could not read config file %s: %s", filename, exc)
         raise SystemExit(1)
 
-    if ini.has_option("general", "solaredge-host"):
-        config["solaredge_host"] = ini.get("general", "solaredge-host")
+    # Return a copy, callers are free to modify the result
+    return dict(_load_config_file(filename, mtime_ns))
+
 
+@functools.lru_cache(maxsize=8)
+def _load_config_file(
+    filename: str, mtime_ns: int  # pylint: disable=unused-argument
+) -> Dict[str, Any]:
+    """
+    Cached worker for `load_config_file()`, which reads and converts
+    the config file. `mtime_ns` is only used as part of the cache key.
+    """
+
+    config: Dict[str, Any] = {}
     try:
-        if ini.has_option("general", "solaredge-port"):
-            config["solaredge_port"] = ini.getint("general", "solaredge-port")
-    except ValueError:
-        LOGGER.error(
-            "%s: %s is not a valid value for solaredge-port",
-            filename,
-            ini.get("general", "solaredge-port"),
-        )
+        general = _parse_ini(filename).get("general", {})
+    except Exception as exc:
+        LOGGER.error("Could not read config file %s: %s", filename, exc)
         raise SystemExit(1)
 
-    if ini.has_option("general", "read-every"):
-        config["read_every"] = ini.get("general", "read-every")
+    for option, key, convert in _CONFIG_OPTIONS:
+        value = general.get(option)
+        if value is None:
+            continue
 
-    if ini.has_option("general", "time-offset"):
-        config["time_offset"] = ini.get("general", "time-offset")
+        try:
+            config[key] = convert(value)
+        except ValueError:
+            LOGGER.error(
+                "%s: %s is not a valid value for %s",
+                filename,
+                value,
+                option,
+            )
+            raise SystemExit(1)
 
-    if ini.has_option("general", "mqtt-host"):
-        config["mqtt_host"] = ini.get("general", "mqtt-host")
+    return config
 
-    try:
-        if ini.has_option("general", "mqtt-port"):
-            config["mqtt_port"] = ini.getint("general", "mqtt-port")
-    except ValueError:
-        LOGGER.error(
-            "%s: %s is not a valid value for mqtt-port",
-            filename,
-            ini.get("general", "mqtt-port"),
-        )
+
+def validate_config(config: Dict[str, Any]) -> None:
+    """
+    Check the completed config (after merging the config file, the
+    command line and the defaults) for missing or invalid values.
+    Terminates the program if a problem is found.
+    """
+
+    if not config.get("solaredge_host"):
+        LOGGER.error("No solaredge host given")
         raise SystemExit(1)
 
-    if ini.has_option("general", "mqtt-client-id"):
-        config["mqtt_client_id"] = ini.get("general", "mqtt-client-id")
+    if not config.get("mqtt_host"):
+        LOGGER.error("No MQTT host given")
+        raise SystemExit(1)
 
-    try:
-        if ini.has_option("general", "buffer-size"):
-            config["buffer_size"] = ini.getint("general", "buffer-size")
-    except ValueError:
-        LOGGER.error(
-            "%s: %s is not a valid value for buffer-size",
-            filename,
-            ini.get("general", "buffer-size"),
-        )
+    for key in ("mqtt_topic", "mqtt_client_id"):
+        if not config[key]:
+            LOGGER.error("%s must not be empty", key.replace("_", "-"))
+            raise SystemExit(1)
+
+    for key in ("solaredge_port", "mqtt_port"):
+        if not 0 < config[key] < 65536:
+            LOGGER.error("%s needs to be between 1 and 65535", key.replace("_", "-"))
+            raise SystemExit(1)
+
+    # A queue size of 0 or less would make the buffer unbounded
+    if config["buffer_size"] <= 0:
+        LOGGER.error("buffer-size needs to be larger than 0")
         raise SystemExit(1)
 
-    return config
+    if config["read_every"] <= 0:
+        LOGGER.error("read-every needs to be larger than 0")
+        raise SystemExit(1)
 
 
-def solaredge_mqtt() -> None:
+def _build_parser() -> "argparse.ArgumentParser":
     """
-    Main function for the solaredge-mqtt script
+    Construct the argument parser for the solaredge-mqtt script
     """
+    # pylint: disable=import-outside-toplevel
+    import argparse
+
     parser = argparse.ArgumentParser()
+    parser.add_argument("--version", action="version", version=__version__)
     parser.add_argument("--config", type=str, help="Configuration file to load")
     parser.add_argument(
         "--mqtt-topic",
@@ -163,7 +297,19 @@ def solaredge_mqtt() -> None:
     )
     parser.add_argument("--debug", action="store_true", help="Enable debug logging")
 
-    args = parser.parse_args()
+    return parser
+
+
+def solaredge_mqtt() -> None:
+    """
+    Main function for the solaredge-mqtt script
+    """
+    # Answer --version without constructing the argument parser
+    if len(sys.argv) == 2 and sys.argv[1] == "--version":
+        print(__version__)
+        return
+
+    args = _build_parser().parse_args()
 
     if args.debug:
         logging.getLogger().setLevel(logging.DEBUG)
@@ -175,95 +321,68 @@ def solaredge_mqtt() -> None:
 
     LOGGER.debug("Config after loading config file: %s", config)
 
-    if args.solaredge_host:
-        config["solaredge_host"] = args.solaredge_host
-
-    if args.solaredge_port:
-        config["solaredge_port"] = args.solaredge_port
-    elif "solaredge_port" not in config:
-        # Not set through config file, not set through CLI, use default
-        config["solaredge_port"] = DEFAULTS["solaredge_port"]
-
-    if args.read_every:
-        config["read_every"] = args.read_every
-    elif "read_every" not in config:
-        # Not set through config file, not set through CLI, use default
-        config["read_every"] = DEFAULTS["read_every"]
-
-    if args.time_offset:
-        config["time_offset"] = args.time_offset
-    elif "time_offset" not in config:
-        # Not set through config file, not set through CLI, use default
-        config["time_offset"] = DEFAULTS["time_offset"]
-
-    if args.mqtt_topic:
-        config["mqtt_topic"] = args.mqtt_topic
-    elif "mqtt_topic" not in config:
-        # Not set through config file, not set through CLI, use default
-        config["mqtt_topic"] = DEFAULTS["mqtt_topic"]
-
-    if args.mqtt_host:
-        config["mqtt_host"] = args.mqtt_host
-
-    if args.mqtt_port:
-        config["mqtt_port"] = args.mqtt_port
-    elif "mqtt_port" not in config:
-        # Not set through config file, not set through CLI, use default
-        config["mqtt_port"] = DEFAULTS["mqtt_port"]
-
-    if args.mqtt_client_id:
-        config["mqtt_client_id"] = args.mqtt_client_id
-    elif "mqtt_client_id" not in config:
-        # Not set through config file, not set through CLI, use default
-        config["mqtt_client_id"] = DEFAULTS["mqtt_client_id"]
-
-    if args.buffer_size:
-        config["buffer_size"] = args.buffer_size
-    elif "buffer_size" not in config:
-        # Not set through config file, not set through CLI, use default
-        config["buffer_size"] = DEFAULTS["buffer_size"]
+    # Settings given on the command line override the config file.
+    # If neither sets a value, use the default (if there is one).
+    for attr, key in _CLI_KEYS:
+        value = getattr(args, attr, None)
+        if value is not None:
+            config[key] = value
+        elif key not in config and key in DEFAULTS:
+            config[key] = DEFAULTS[key]
 
     LOGGER.debug("Completed config: %s", config)
 
-    if "solaredge_host" not in config:
-        LOGGER.error("No solaredge host given")
-        raise SystemExit(1)
-
-    if "mqtt_host" not in config:
-        LOGGER.error("No MQTT host given")
-        raise SystemExit(1)
+    validate_config(config)
+
+    # These are imported here instead of at the top of the file, so
+    # that argument parsing errors and --help do not have to pay for
+    # loading multiprocessing and the modbus/MQTT libraries.
+    # pylint: disable=import-outside-toplevel
+    import multiprocessing
+    import multiprocessing.connection
+
+    from .mqtt import mqtt_main
+    from .solaredge import solaredge_main
+
+    # Use fork on Linux, so the child processes inherit the config
+    # and the queue instead of having them pickled and having to import
+    # this program again. This is the default with older Python
+    # versions, but not on newer ones. Other platforms keep their
+    # default, fork is not available (Windows) or unsafe (macOS) there.
+    mp_context: multiprocessing.context.BaseContext
+    if sys.platform.startswith("linux"):
+        mp_context = multiprocessing.get_context("fork")
+    else:
+        mp_context = multiprocessing.get_context()
 
-    solaredge_mqtt_queue: multiprocessing.Queue = multiprocessing.Queue(
+    solaredge_mqtt_queue: multiprocessing.Queue = mp_context.Queue(
         maxsize=config["buffer_size"]
     )
 
-    procs: List[multiprocessing.Process] = []
-    solaredge_proc = multiprocessing.Process(
+    procs: List[multiprocessing.process.BaseProcess] = []
+    solaredge_proc = mp_context.Process(
         target=solaredge_main, name="solaredge", args=(solaredge_mqtt_queue, config)
     )
     solaredge_proc.start()
     procs.append(solaredge_proc)
 
-    mqtt_proc = multiprocessing.Process(
+    mqtt_proc = mp_context.Process(
         target=mqtt_main, name="mqtt", args=(solaredge_mqtt_queue, config)
     )
     mqtt_proc.start()
     procs.append(mqtt_proc)
 
     # Wait forever for one of the processes to die. If that happens,
-    # kill the whole program.
-    run = True
-    while run:
-        try:
-            for proc in procs:
-                if not proc.is_alive():
-                    LOGGER.error("Child process died, terminating program")
-                    run = False
-
-            time.sleep(1)
-        except KeyboardInterrupt:
-            LOGGER.info("Caught keyboard interrupt, exiting")
-            run = False
+    # kill the whole program. The sentinel of a process becomes ready
+    # when the process exits, so this does not need to wake up
+    # periodically to check on the children.
+    try:
+        ready = multiprocessing.connection.wait([proc.sentinel for proc in procs])
+        for proc in procs:
+            if proc.sentinel in ready:
+                LOGGER.error("Child process %s died, terminating program", proc.name)
+    except KeyboardInterrupt:
+        LOGGER.info("Caught keyboard interrupt, exiting")
 
     for proc in procs:
         proc.terminate()
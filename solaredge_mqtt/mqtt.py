@@ -4,7 +4,6 @@ Solaredge to MQTT gateway
 This file contains the mqtt specific code
 """
 
-import json
 import logging
 import multiprocessing
 import threading
@@ -92,13 +91,20 @@ def mqtt_main(queue: multiprocessing.Queue, config: Dict[str, Any]) -> None:
 
         break
 
+    # The log level does not change while running, so only check
+    # once whether debug messages from the loop below are wanted
+    debug = LOGGER.isEnabledFor(logging.DEBUG)
+
     while True:
         # This will sleep unless we're connected
         with connected_cv:
             connected_cv.wait_for(lambda: connected)
 
-        data = queue.get(block=True)
-        LOGGER.debug("Read from queue: %s", data)
+        # Each entry is a tuple of the serial number of the device
+        # and the JSON encoded data to publish
+        serial, payload = queue.get(block=True)
+        if debug:
+            LOGGER.debug("Read from queue: %s", payload)
 
         # The paho thread may have died (see
         # https://github.com/eclipse/paho.mqtt.python/pull/674)
@@ -110,7 +116,7 @@ def mqtt_main(queue: multiprocessing.Queue, config: Dict[str, Any]) -> None:
         client.publish(
             config["mqtt_topic"]
             % {
-                "serial": data["c_serialnumber"],
+                "serial": serial,
             },
-            json.dumps(data),
+            payload,
         )
@@ -4,16 +4,14 @@ Solaredge to MQTT gateway
 This contains the solaredge/modbus specific parts
 """
 
+import json
 import logging
 import math
 import multiprocessing
-import threading
+import queue
 import time
 from typing import Any, Dict, Tuple
 
-import solaredge_modbus  # type: ignore
-from pymodbus.exceptions import ConnectionException  # type: ignore
-
 LOGGER = logging.getLogger(__name__)
 
 # A dictionary matching scale factors to the values they
@@ -40,6 +38,41 @@ SCALEFACTORS: Dict[str, Tuple] = {
     "temperature_scale": ("temperature",),
 }
 
+# The inverse of SCALEFACTORS, matching each value to the scale
+# factor that applies to it
+FIELD_TO_SCALE: Dict[str, str] = {
+    field: scale for scale, fields in SCALEFACTORS.items() for field in fields
+}
+SCALE_KEYS: Tuple[str, ...] = tuple(SCALEFACTORS.keys())
+
+# Powers of ten for the range of scale factors the inverters
+# report, so they do not have to be calculated on every read
+_POW10: Dict[int, Any] = {i: 10 ** i for i in range(-8, 9)}
+
+
+def scale_data(data: Dict[str, Any]) -> None:
+    """
+    Apply the scale factors in `data` to the values they belong to,
+    and remove the scale factors. `data` is modified in place.
+
+    The values, as read from the inverter, need to be scaled
+    according to a scale factor that's also present in the data.
+    Raises KeyError if a value is present without its scale factor.
+    """
+
+    scales: Dict[str, Any] = {
+        key: _POW10.get(data[key]) or 10 ** data[key]
+        for key in SCALE_KEYS
+        if key in data
+    }
+    for field, scale in FIELD_TO_SCALE.items():
+        value = data.get(field)
+        if value is not None:
+            data[field] = value * scales[scale]
+
+    for key in SCALE_KEYS:
+        data.pop(key, None)
+
 
 def solaredge_main(mqtt_queue: multiprocessing.Queue, config: Dict[str, Any]) -> None:
     """
@@ -55,12 +88,22 @@ def solaredge_main(mqtt_queue: multiprocessing.Queue, config: Dict[str, Any]) ->
     take. This is a concious tradeoff.
     """
 
+    # Imported here so that the parent process, which only needs
+    # this module to find the process target, does not load pymodbus
+    # pylint: disable=import-outside-toplevel
+    import solaredge_modbus  # type: ignore
+    from pymodbus.exceptions import ConnectionException  # type: ignore
+
     LOGGER.info("solaredge process starting")
 
     inverter = solaredge_modbus.Inverter(
         host=config["solaredge_host"], port=config["solaredge_port"], timeout=5
     )
 
+    # The log level does not change while running, so only check
+    # once whether debug messages from the loop below are wanted
+    debug = LOGGER.isEnabledFor(logging.DEBUG)
+
     # This is a correction term that is used to adjust for the fact
     # that waking up from sleep takes a while.
     epsilon = 0
@@ -68,35 +111,63 @@ def solaredge_main(mqtt_queue: multiprocessing.Queue, config: Dict[str, Any]) ->
     # We want to run execution on seconds that are divisible by this
     synctime = config["read_every"]
 
+    # Offset applied to the time stamps sent to MQTT
+    time_offset = config["time_offset"]
+
     # If the scheduled start time and the actual start time is
     # off by more than this, skip the run
     maxdelta = 0.05
 
-    # This object is purely used to sleep on
-    event = threading.Event()
+    # The first run is scheduled for the next multiple of synctime on
+    # the wall clock. After that the schedule is kept on the monotonic
+    # clock, so steps of the system time (NTP) do not disturb it.
+    now = time.time()
+    nextrun = time.monotonic() + math.ceil(now / synctime) * synctime - now
 
     while True:
         # Time where the next execution is supposed to happen
-        now = time.time()
-        nextrun = math.ceil(now / synctime) * synctime
+        now = time.monotonic()
+        if nextrun < now:
+            # We fell behind the schedule, for example after an error
+            # reading from the inverter. Move on to the next slot that
+            # is still in the future
+            nextrun += math.ceil((now - nextrun) / synctime) * synctime
         sleep = nextrun - now - epsilon
 
         if sleep < 0:
             # This can happen if we're very close to nextrun, and
-            # epsilon is negative. In this case restart the loop,
-            # which should push us into the next interval
+            # epsilon is positive. In this case skip to the next
+            # interval
             LOGGER.error(
                 "Skipping loop due to negative sleep interval. If "
                 "this keeps happening, increase --read-every"
             )
+            nextrun += synctime
             continue
 
-        # This is a lot more accurate than time.sleep()
-        event.wait(timeout=sleep)
+        time.sleep(sleep)
 
-        start = time.time()
+        start = time.monotonic()
         delta = start - nextrun
 
+        # The wall clock time this run was scheduled for, and the
+        # multiple of synctime closest to it. The latter is used for the
+        # time stamp sent to MQTT
+        scheduled_wall = time.time() - delta
+        nextrun_wall = round(scheduled_wall / synctime) * synctime
+
+        drift = scheduled_wall - nextrun_wall
+        if abs(drift) > maxdelta:
+            # The system time was changed (NTP step), so the schedule is
+            # no longer aligned to the wall clock. Move nextrun back to a
+            # multiple of synctime and skip this run, instead of sending
+            # a time stamp that does not match the time of the read.
+            # If that point is in the past, the top of the loop moves on
+            # to the next one
+            LOGGER.error("System time changed, schedule is off by %f, resyncing", drift)
+            nextrun -= drift
+            continue
+
         # These are the various times involved here:
         #
         #    T_1            T_2  T_3   T_4
@@ -106,7 +177,7 @@ def solaredge_main(mqtt_queue: multiprocessing.Queue, config: Dict[str, Any]) ->
         #
         # T_1 is the time where we went to sleep
         # T_2 is the time were the sleep should have ended. T_2 - T_1 is
-        #   the duration we pass to the event.wait() call.
+        #   the duration we pass to the time.sleep() call.
         # T_3 is the time where we wanted to come out of sleep. T_3 - T_2
         #   is `epsilon`, and in an ideal world it would be 0.
         # T_4 is the time where we actually came out of the sleep, this
@@ -150,13 +221,16 @@ def solaredge_main(mqtt_queue: multiprocessing.Queue, config: Dict[str, Any]) ->
             )
             epsilon = 0
 
-        LOGGER.debug(
-            "Starting loop at %f, desired was %f, delta %f, new epsilon %f",
-            start,
-            nextrun,
-            delta,
-            epsilon,
-        )
+        if debug:
+            LOGGER.debug(
+                "Starting loop at %f, desired was %f, delta %f, new epsilon %f",
+                start,
+                nextrun,
+                delta,
+                epsilon,
+            )
+
+        nextrun += synctime
 
         if abs(delta) > maxdelta:
             LOGGER.error("Skipping run, offset too large")
@@ -168,36 +242,35 @@ def solaredge_main(mqtt_queue: multiprocessing.Queue, config: Dict[str, Any]) ->
             if data == {}:
                 raise ValueError("No data from inverter")
 
-            LOGGER.debug("Received values from inverter: %s", data)
+            if debug:
+                LOGGER.debug("Received values from inverter: %s", data)
 
             if "c_serialnumber" not in data:
                 raise KeyError("No serial number in data")
 
-            # The values, as read from the inverter, need to be scaled
-            # according to a scale factor that's also present in the data.
-            #
-            # This might also fail because the data received is incomplete
-            for scalefactor, fields in SCALEFACTORS.items():
-                for field in fields:
-                    if field in data:
-                        data[field] = data[field] * (10 ** data[scalefactor])
-
-                del data[scalefactor]
+            # This might fail because the data received is incomplete
+            scale_data(data)
 
-            LOGGER.debug("Processed data: %s", data)
+            if debug:
+                LOGGER.debug("Processed data: %s", data)
 
         except (KeyError, ValueError, ConnectionException) as exc:
             LOGGER.error("Error reading from inverter: %s, data: %s", exc, data)
             LOGGER.error("Sleeping for 5 seconds")
-            event.wait(timeout=5)
+            time.sleep(5)
             continue
 
         # Add a time stamp. This is an integer, in milliseconds
         # since epoch
-        data["solaredge_mqtt_timestamp"] = int((nextrun - config["time_offset"]) * 1000)
+        data["solaredge_mqtt_timestamp"] = int((nextrun_wall - time_offset) * 1000)
+
+        # The data is serialized here, once, so the MQTT process can
+        # publish it as is. The serial number is sent along because
+        # it is needed for the topic
+        payload = json.dumps(data)
 
         try:
-            mqtt_queue.put(data, block=False)
-        except Exception:
-            # Ignore this
+            mqtt_queue.put((data["c_serialnumber"], payload), block=False)
+        except queue.Full:
+            # The buffer is full, drop this measurement
             pass
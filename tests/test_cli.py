@@ -0,0 +1,201 @@
+"""
+Tests for the config file handling in solaredge_mqtt.cli
+"""
+
+import configparser
+import os
+from pathlib import Path
+
+import pytest
+
+from solaredge_mqtt.cli import DEFAULTS, _parse_ini, load_config_file, validate_config
+
+
+def write_config(tmp_path: Path, content: str) -> str:
+    """
+    Write `content` to a config file in `tmp_path`, return the file name
+    """
+    path = tmp_path / "config.ini"
+    path.write_text(content, encoding="utf-8")
+    return str(path)
+
+
+def configparser_sections(filename: str) -> dict:
+    """
+    Parse `filename` with configparser, for comparison
+    """
+    ini = configparser.ConfigParser(interpolation=None)
+    with open(filename, encoding="utf-8") as configfile:
+        ini.read_file(configfile)
+    return {name: dict(ini.items(name)) for name in ini.sections()}
+
+
+@pytest.mark.parametrize(
+    "content",
+    [
+        "[general]\nmqtt-host = mqtt.example.com\n",
+        "[general]\nsolaredge-host: 1.2.3.4\n",
+        "[general]\nmqtt-host=a:b\nmqtt-topic: x=y\n",
+        "# comment\n; comment\n[general]\n  # indented comment\nMQTT-Host = a\n",
+        "[DEFAULT]\nmqtt-port = 1884\n[general]\nmqtt-host = a\n",
+        "[DEFAULT]\nmqtt-port = 1884\n[general]\nmqtt-port = 1885\n",
+        "[general]\nmqtt-topic = a\n  b\n\tc\nmqtt-host = d\n",
+        "[general]\nmqtt-host =\n[other]\nmqtt-host = b\n",
+        "[general]\n  mqtt-host = a\n  mqtt-port = 1\n",
+        "  [general]\n  mqtt-topic = a\n    b\n  mqtt-host = c\n",
+        "[general]\nmqtt-topic = a\n\n  b\n\nmqtt-host = c\n\n",
+        "[general]\nmqtt-topic = a\n# comment\n  b\n",
+        "[general] ; comment\nmqtt-host = a\n",
+        "[ general ]\nmqtt-host = a\n",
+        "[DEFAULT]\nmqtt-port = 1884\n[DEFAULT]\nmqtt-host = a\n[general]\n",
+    ],
+)
+def test_parse_ini_matches_configparser(tmp_path: Path, content: str) -> None:
+    """
+    The ini parser gives the same result as configparser
+    """
+    filename = write_config(tmp_path, content)
+    assert _parse_ini(filename) == configparser_sections(filename)
+
+
+@pytest.mark.parametrize(
+    "content",
+    [
+        "mqtt-host = a\n",
+        "[general]\nmqtt-host\n",
+        "[general\nmqtt-host = a\n",
+        "[general]\nmqtt-host = a\nmqtt-host = b\n",
+        "[general]\n[general]\n",
+        "[general]\n= value\n",
+        "[general]\n  : value\n",
+        "[]\nmqtt-host = a\n",
+        "[general]\nMQTT-host = a\nmqtt-HOST = b\n",
+    ],
+)
+def test_parse_ini_errors(tmp_path: Path, content: str) -> None:
+    """
+    Files configparser rejects are rejected as well
+    """
+    filename = write_config(tmp_path, content)
+    with pytest.raises(configparser.Error):
+        configparser_sections(filename)
+    with pytest.raises(ValueError):
+        _parse_ini(filename)
+
+
+def test_load_config_file(tmp_path: Path) -> None:
+    """
+    Options from the general section are converted and stored
+    under their config keys
+    """
+    filename = write_config(
+        tmp_path,
+        "[general]\n"
+        "solaredge-host = 192.168.1.1\n"
+        "solaredge-port = 1503\n"
+        "read-every = 2.5\n"
+        "time-offset: 1\n"
+        "mqtt-host = mqtt.example.com\n"
+        "unknown = ignored\n",
+    )
+    assert load_config_file(filename) == {
+        "solaredge_host": "192.168.1.1",
+        "solaredge_port": 1503,
+        "read_every": 2.5,
+        "time_offset": 1.0,
+        "mqtt_host": "mqtt.example.com",
+    }
+
+
+def test_load_config_file_returns_copy(tmp_path: Path) -> None:
+    """
+    Modifying the result does not change what later calls return
+    """
+    filename = write_config(tmp_path, "[general]\nmqtt-host = a\n")
+    load_config_file(filename)["mqtt_host"] = "b"
+    assert load_config_file(filename) == {"mqtt_host": "a"}
+
+
+def test_load_config_file_reloads_changed_file(tmp_path: Path) -> None:
+    """
+    A config file is read again once its modification time changes
+    """
+    filename = write_config(tmp_path, "[general]\nmqtt-host = a\n")
+    mtime_ns = os.stat(filename).st_mtime_ns
+    assert load_config_file(filename) == {"mqtt_host": "a"}
+
+    write_config(tmp_path, "[general]\nmqtt-host = b\n")
+    os.utime(filename, ns=(mtime_ns, mtime_ns))
+    assert load_config_file(filename) == {"mqtt_host": "a"}
+
+    os.utime(filename, ns=(mtime_ns + 1_000_000_000, mtime_ns + 1_000_000_000))
+    assert load_config_file(filename) == {"mqtt_host": "b"}
+
+
+@pytest.mark.parametrize(
+    "content",
+    [
+        "[general]\nmqtt-port = abc\n",
+        "[general]\nmqtt-host\n",
+    ],
+)
+def test_load_config_file_invalid(tmp_path: Path, content: str) -> None:
+    """
+    Invalid config files terminate the program
+    """
+    filename = write_config(tmp_path, content)
+    with pytest.raises(SystemExit):
+        load_config_file(filename)
+
+
+def test_load_config_file_missing(tmp_path: Path) -> None:
+    """
+    A missing config file terminates the program
+    """
+    with pytest.raises(SystemExit):
+        load_config_file(str(tmp_path / "missing.ini"))
+
+
+def valid_config(**overrides: object) -> dict:
+    """
+    A complete, valid config with `overrides` applied
+    """
+    config = dict(DEFAULTS, solaredge_host="192.168.1.1", mqtt_host="mqtt")
+    config.update(overrides)
+    return config
+
+
+def test_validate_config() -> None:
+    """
+    A complete config with the default values is accepted
+    """
+    validate_config(valid_config())
+
+
+@pytest.mark.parametrize(
+    "overrides",
+    [
+        {"solaredge_host": None},
+        {"solaredge_host": ""},
+        {"mqtt_host": None},
+        {"mqtt_host": ""},
+        {"mqtt_topic": ""},
+        {"mqtt_client_id": ""},
+        {"solaredge_port": 0},
+        {"mqtt_port": -1},
+        {"mqtt_port": 65536},
+        {"buffer_size": 0},
+        {"buffer_size": -5},
+        {"read_every": 0},
+        {"read_every": -1.5},
+    ],
+)
+def test_validate_config_invalid(overrides: dict) -> None:
+    """
+    Missing, empty or out of range values terminate the program
+    """
+    config = valid_config(**overrides)
+    for key in [key for key, value in overrides.items() if value is None]:
+        del config[key]
+    with pytest.raises(SystemExit):
+        validate_config(config)
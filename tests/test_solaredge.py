@@ -0,0 +1,213 @@
+"""
+Tests for solaredge_mqtt.solaredge
+"""
+
+import json
+import sys
+import types
+from typing import Any, Dict, List, Optional
+
+import pytest
+
+from solaredge_mqtt import solaredge
+
+
+def test_scale_data() -> None:
+    """
+    Values are scaled by their scale factor, and the scale factors
+    are removed
+    """
+    data = {
+        "c_serialnumber": "1234",
+        "current": 1234,
+        "p1_current": 5,
+        "current_scale": -2,
+        "energy_total": 7,
+        "energy_total_scale": 3,
+        "temperature": 42,
+        "temperature_scale": 0,
+    }
+    solaredge.scale_data(data)
+    assert data == {
+        "c_serialnumber": "1234",
+        "current": pytest.approx(12.34),
+        "p1_current": pytest.approx(0.05),
+        "energy_total": 7000,
+        "temperature": 42,
+    }
+    assert isinstance(data["energy_total"], int)
+    assert isinstance(data["current"], float)
+
+
+def test_scale_data_missing_scale_and_values() -> None:
+    """
+    A scale factor that is missing together with its values is not an error
+    """
+    data = {"power_ac": 10, "power_ac_scale": 1}
+    solaredge.scale_data(data)
+    assert data == {"power_ac": 100}
+
+
+def test_scale_data_missing_scale() -> None:
+    """
+    A value without its scale factor can not be scaled
+    """
+    with pytest.raises(KeyError):
+        solaredge.scale_data({"power_ac": 10})
+
+
+class FakeClock:
+    """
+    Replacement for time.monotonic(), time.time() and time.sleep().
+
+    Sleeping advances both clocks by the requested duration plus a
+    small wakeup latency. `steps` maps a read count to a change of
+    the wall clock that happens during the sleep after that read.
+    """
+
+    def __init__(self, steps: Optional[Dict[int, float]] = None) -> None:
+        self.mono = 1000.0
+        self.wall = 1_700_000_000.3
+        self.reads = 0
+        self.steps = dict(steps or {})
+
+    def monotonic(self) -> float:
+        return self.mono
+
+    def time(self) -> float:
+        return self.wall
+
+    def sleep(self, duration: float) -> None:
+        self.mono += duration + 0.001
+        self.wall += duration + 0.001
+        self.wall += self.steps.pop(self.reads, 0)
+
+
+class Done(Exception):
+    """
+    Raised by the fake queue to end the reader loop
+    """
+
+
+class FakeQueue:
+    """
+    Collects the readings put into it, ends the loop after `count`
+    """
+
+    def __init__(self, count: int) -> None:
+        self.count = count
+        self.items: List[Dict[str, Any]] = []
+
+    def put(self, item: Any, block: bool = True) -> None:
+        self.items.append(json.loads(item[1]))
+        if len(self.items) >= self.count:
+            raise Done()
+
+
+def run_reader(
+    monkeypatch: pytest.MonkeyPatch,
+    clock: FakeClock,
+    count: int,
+    fail_reads: tuple = (),
+) -> List[Dict[str, Any]]:
+    """
+    Run solaredge_main() against a fake inverter until `count`
+    readings have been queued, and return them. Reads with a number
+    in `fail_reads` return no data.
+    """
+
+    class Inverter:
+        def __init__(self, **kwargs: Any) -> None:
+            pass
+
+        def read_all(self) -> Dict[str, Any]:
+            clock.reads += 1
+            if clock.reads in fail_reads:
+                return {}
+            return {
+                "c_serialnumber": "1234",
+                "power_ac": 5,
+                "power_ac_scale": 0,
+                "read_at": clock.wall,
+            }
+
+    modbus = types.ModuleType("solaredge_modbus")
+    modbus.Inverter = Inverter  # type: ignore[attr-defined]
+    exceptions = types.ModuleType("pymodbus.exceptions")
+    exceptions.ConnectionException = ConnectionError  # type: ignore[attr-defined]
+    monkeypatch.setitem(sys.modules, "solaredge_modbus", modbus)
+    monkeypatch.setitem(sys.modules, "pymodbus", types.ModuleType("pymodbus"))
+    monkeypatch.setitem(sys.modules, "pymodbus.exceptions", exceptions)
+
+    monkeypatch.setattr(solaredge.time, "monotonic", clock.monotonic)
+    monkeypatch.setattr(solaredge.time, "time", clock.time)
+    monkeypatch.setattr(solaredge.time, "sleep", clock.sleep)
+
+    mqtt_queue = FakeQueue(count)
+    config = {
+        "solaredge_host": "inverter",
+        "solaredge_port": 1502,
+        "read_every": 5,
+        "time_offset": 0,
+    }
+    with pytest.raises(Done):
+        solaredge.solaredge_main(mqtt_queue, config)  # type: ignore[arg-type]
+    return mqtt_queue.items
+
+
+def assert_on_grid(items: List[Dict[str, Any]]) -> None:
+    """
+    Every reading is stamped with a multiple of read_every that
+    matches the time it was actually read
+    """
+    for item in items:
+        stamp = item["solaredge_mqtt_timestamp"] / 1000
+        assert stamp % 5 == 0
+        assert abs(item["read_at"] - stamp) < 0.05
+
+
+def stamps(items: List[Dict[str, Any]]) -> List[int]:
+    """
+    The time stamps of `items`, in seconds
+    """
+    return [item["solaredge_mqtt_timestamp"] // 1000 for item in items]
+
+
+def test_schedule(monkeypatch: pytest.MonkeyPatch) -> None:
+    """
+    Readings are taken every read_every seconds, aligned to the wall clock
+    """
+    items = run_reader(monkeypatch, FakeClock(), 5)
+    assert_on_grid(items)
+    assert stamps(items) == [1_700_000_005 + 5 * i for i in range(5)]
+
+
+@pytest.mark.parametrize(
+    "step, expected",
+    [
+        # The run at :20 comes out at :22.4 and is skipped while resyncing
+        (2.4, [5, 10, 15, 25, 30, 35, 40, 45]),
+        # The run at :20 comes out at :12.9 and is skipped, the clock
+        # went back so :15 is read again
+        (-7.1, [5, 10, 15, 15, 20, 25, 30, 35]),
+    ],
+)
+def test_schedule_clock_step(
+    monkeypatch: pytest.MonkeyPatch, step: float, expected: List[int]
+) -> None:
+    """
+    After a step of the wall clock, the schedule moves back onto the grid
+    """
+    items = run_reader(monkeypatch, FakeClock(steps={3: step}), 8)
+    assert_on_grid(items)
+    assert stamps(items) == [1_700_000_000 + i for i in expected]
+
+
+def test_schedule_error_backoff(monkeypatch: pytest.MonkeyPatch) -> None:
+    """
+    After the sleep following a failed read, the schedule continues
+    with the next slot on the grid
+    """
+    items = run_reader(monkeypatch, FakeClock(), 6, fail_reads=(2,))
+    assert_on_grid(items)
+    assert stamps(items) == [1_700_000_000 + i for i in (5, 20, 25, 30, 35, 40)]
@@ -0,0 +1,20 @@
+"""
+Tests for the package version
+"""
+
+import re
+from pathlib import Path
+
+from solaredge_mqtt import __version__
+
+
+def test_version_matches_pyproject() -> None:
+    """
+    __version__ is kept in sync with the version in pyproject.toml
+    """
+    pyproject = Path(__file__).parent.parent / "pyproject.toml"
+    match = re.search(
+        r'^version = "([^"]+)"$', pyproject.read_text(encoding="utf-8"), re.MULTILINE
+    )
+    assert match is not None
+    assert __version__ == match.group(1)